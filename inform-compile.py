@@ -1,9 +1,12 @@
 #!/usr/bin/python
 import base64
-import chardet
+import codecs
+import collections
+import concurrent.futures
 import docopt
 import hashlib
 import humanize
+import itertools
 import logging
 import os
 import re
@@ -12,14 +15,19 @@ import tempfile
 import time
 import subprocess
 
+try:
+    import cchardet as _chardet  # Faster C implementation, if available
+except ImportError:
+    import chardet as _chardet
+
 version = '0.5'
 
 __doc__ = """inform-compile.py {version} --- Compilation of Inform source to story files
 Usage:
   {filename} --informbin=<name> [--tmpdir=<name>] [--devstage=<name>] [--dev|--release]
              [--language=<name>] [--librarypaths=<name>]
-             [--unicode] [--outdirectory=<name>] [--storyfileprefix=<name>]
-             [--gluxl] [--vorple]
+             [--unicode] [--encoding=<name>] [--outdirectory=<name>]
+             [--storyfileprefix=<name>] [--gluxl] [--vorple]
              [--storyfilesuffix=<name>] [--nostorysuffix]
              [--storyfileversion=<num>] [--writejs]
              [--force] [-v ...] <infiles>...
@@ -41,6 +49,8 @@ Options:
                             see http://inform-fiction.org/manual/html/s45.html
   --unicode -u              Source file is in unicode encoding.
                                                               [default: false].
+  --encoding=<name>         Encoding of source file (skips detection).
+                                       (default is detected from source file).
   --vorple                  Compile a Vorple game. [default: false].
   --gluxl                   Compile a Gluxl game. [default: false].
   --outdirectory=<name>     Output directory for story files.
@@ -62,50 +72,216 @@ This is free software: you are free to change and redistribute it. There is NO
 WARRANTY, to the extent permitted by law.
 """.format(filename=os.path.basename(__file__), version=version)
 
+# Metadata header line: either a '! Field: value' comment, a Release
+# directive or a Serial directive (one alternative per line)
+_HEADER_RE = re.compile(r'^(?:! (\w+):(.*)|Release (\d+)|Serial "(\d+)")')
+# Metadata is assumed to live in a short header at the top of the source
+# file, terminated by the first blank line. Never read more lines than this.
+_HEADER_MAXLINES = 200
+_DANISH_ALIASES = frozenset({'danish', 'dansk'})
+
+# Compile in parallel worker processes from this many infiles
+_PARALLEL_MIN_INFILES = 4
+
+InFile = collections.namedtuple('InFile', ['path', 'dirname', 'basename',
+                                           'metadata', 'storyfilename'])
+CompilerOutput = collections.namedtuple('CompilerOutput', ['stdout', 'stderr'])
+
 
 def md5(filename):
-    hash = hashlib.md5()
     with open(filename, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
+        if hasattr(hashlib, 'file_digest'):  # Python >= 3.11
+            return hashlib.file_digest(f, 'md5').hexdigest()
+        hash = hashlib.md5()
+        for chunk in iter(lambda: f.read(1 << 20), b""):
             hash.update(chunk)
     return hash.hexdigest()
 
 
-def filesize(filename):
-    return humanize.naturalsize(os.path.getsize(filename), gnu=True)
+def filesize(size_or_path):
+    if isinstance(size_or_path, int):  # Size already known, e.g. from os.stat
+        size = size_or_path
+    else:
+        size = os.path.getsize(size_or_path)
+    return humanize.naturalsize(size, gnu=True)
 
 
-def getmetadata(filename):
+def getmetadata(filename, encoding=None):
     metadata = {}
     keys = []
-    pattern = re.compile('^! \\w+:')
-    storyfile_releasenumber = []
-    storyfile_serialnumber = []
-    releasenumber_pattern = re.compile('^Release \\d+')
-    serialnumber_pattern = re.compile('^Serial "\\d+"')
-    number_pattern = re.compile('\\d+')
-    rawdata = open(filename, 'rb').read()
-    result = chardet.detect(rawdata)
-    charenc = result['encoding']
-    for line in open(filename, encoding=charenc):
-        if re.findall(pattern, line):
-            fieldname, value = line.split(':')
-            fieldname = fieldname.split(' ')[1:][0].lower()
-            metadata[fieldname] = value.rstrip('\n').strip()
+    # Read the header (up to the first blank line) once; the same raw
+    # bytes are used for encoding detection and parsed below
+    rawlines = []
+    with open(filename, 'rb') as f:
+        for lineno, rawline in enumerate(f):
+            if rawline in (b'\n', b'\r\n') or lineno >= _HEADER_MAXLINES:
+                break
+            rawlines.append(rawline)
+    rawheader = b''.join(rawlines)
+    if rawheader.startswith(codecs.BOM_UTF8):  # Also for --encoding=utf-8
+        rawheader = rawheader[len(codecs.BOM_UTF8):]
+    if encoding is None:
+        if rawheader.isascii():  # Common case, no need for detection
+            encoding = 'ascii'
+        else:
+            encoding = _chardet.detect(rawheader)['encoding'] or 'utf-8'
+    header = rawheader.decode(encoding, errors='replace')
+    for line in header.splitlines():
+        m = _HEADER_RE.match(line)
+        if m is None:
+            continue
+        fieldname, value, releasenumber, serialnumber = m.groups()
+        if fieldname is not None:
+            fieldname = fieldname.lower()
+            metadata[fieldname] = value.strip()
             keys.append(fieldname)
-        elif re.findall(releasenumber_pattern, line):
-            releasenumber = re.findall(releasenumber_pattern, line)[0]
-            metadata['release'] = releasenumber.split()[1]
+        elif releasenumber is not None:
+            metadata['release'] = releasenumber
             keys.append('release')
-        elif re.findall(serialnumber_pattern, line):
-            serialnumber = re.findall(serialnumber_pattern, line)[0]
-            metadata['serial'] = serialnumber.split()[1][1:-1]
+        else:
+            metadata['serial'] = serialnumber
             keys.append('serial')
-        elif line == '\n':
-            break
 
     return metadata, keys
 
+
+def getstoryfilename(infiledirname, infilebasename, metadata, args):
+    outdirectory = args['--outdirectory']
+    if not outdirectory:
+        outdirectory = infiledirname
+
+    storyfileprefix = args['--storyfileprefix'] or ''
+
+    storyfilesuffix = args['--storyfilesuffix']
+    if not storyfilesuffix:
+        if 'release' in metadata.keys():
+            storyfile_releasenumber = metadata['release']
+        else:
+            storyfile_releasenumber = '1'  # Default release number
+
+        if 'serial' in metadata.keys():
+            storyfile_serialnumber = metadata['serial']
+        else:
+            # Default serial number
+            storyfile_serialnumber = time.strftime('%y%m%d')
+
+        storyfilesuffix = '_' + storyfile_releasenumber + '_' \
+                          + storyfile_serialnumber
+
+    if args['--nostorysuffix']:
+        storyfilesuffix = ''
+
+    if args['--gluxl']:
+        storyfileextension = '.ulx'
+    else:
+        storyfileextension = f".z{args['--storyfileversion']}"
+
+    storyfilename = os.path.join(
+        outdirectory,
+        f"{storyfileprefix}{infilebasename}{storyfilesuffix}"
+        f"{storyfileextension}")
+
+    return storyfilename
+
+
+def compile_one(infileinfo, args, base_cmd, capture=False):
+    """Compile a single InFile, returning (returncode, records)."""
+    infile, infiledirname, infilebasename, metadata, storyfilename = infileinfo
+    records = []
+
+    log = logging.getLogger(os.path.basename(__file__))
+    if capture:
+        # In a worker process: collect (level, msg, args) records and the
+        # CompilerOutput for the parent to replay in order
+        def record(level, msg, *msgargs):
+            records.append((level, msg, msgargs))
+    else:
+        record = log.log
+
+    record(logging.INFO, 'Building command string')
+
+    command = list(base_cmd)
+
+    language = args['--language']
+    if 'sprog' in metadata.keys():
+        language = metadata['sprog']
+
+    if language.lower() in _DANISH_ALIASES:
+        command.append('+language_name=Danish')
+
+    # Append source file dir to library paths
+    if args['--librarypaths']:
+      librarypaths = '+'+args['--librarypaths']+','+infiledirname
+      command.append(librarypaths)
+
+    command.append(infile)
+    command.append(storyfilename)
+    record(logging.INFO, 'Compiling infile with command: %s',
+           ' '.join(command))
+    try:
+        completed = subprocess.run(command, check=False,
+                                   capture_output=capture)
+    except Exception as ex:
+        if capture:  # Tracebacks do not survive the trip to the parent
+            record(logging.ERROR, 'Exception: %s', ex)
+        else:
+            log.exception('Exception: %s', ex)
+        return 1, records
+    if capture:
+        records.append(CompilerOutput(completed.stdout, completed.stderr))
+
+    if completed.returncode != 0:
+        record(logging.ERROR, 'Compilation of file: %s unsuccessful', infile)
+        return 1, records
+    else:
+        record(logging.INFO, 'Compilation of file: %s successful', infile)
+        try:
+            storyfile_stat = os.stat(storyfilename)
+        except FileNotFoundError:
+            record(logging.ERROR, 'Compilation of file: %s successful, but '
+                   'storyfile: %s not found', infile, storyfilename)
+            return 1, records
+        record(logging.INFO, 'Wrote storyfile: %s', storyfilename)
+        if args['--writejs']:
+            # Read once; the contents are reused for the base64 encoding
+            with open(storyfilename, "rb") as f:
+                contents = f.read()
+            storyfile_md5sum = hashlib.md5(contents).hexdigest()
+        else:
+            storyfile_md5sum = md5(storyfilename)
+        record(logging.INFO, 'Storyfile md5sum: %s', storyfile_md5sum)
+        storyfile_size = filesize(storyfile_stat.st_size)
+        record(logging.INFO, 'Storyfile size: %s', storyfile_size)
+
+    # FIXME TODO write readme.txt with metadata?
+
+    if args['--writejs']:
+        record(logging.INFO, 'Base64 encoding of the storyfile for '
+               ' parchment (javascript)')
+        # Based on code from parchment, zcode2js.py
+        # Write the parts separately (the base64 payload must stay on a
+        # single line) to avoid building another copy of the payload
+        base64hash = hashlib.md5()
+        base64size = 0
+        base64storyfilename = storyfilename + '.js'
+        with open(base64storyfilename, 'wb') as f:
+            for part in (b"processBase64Zcode('",
+                         base64.b64encode(contents), b"');"):
+                f.write(part)
+                base64hash.update(part)
+                base64size += len(part)
+        record(logging.INFO, 'Wrote base64 encoded storyfile: %s',
+               base64storyfilename)
+        base64storyfile_md5sum = base64hash.hexdigest()
+        record(logging.INFO, 'Base64 encoded storyfile md5sum: %s',
+               base64storyfile_md5sum)
+        base64storyfile_size = filesize(base64size)
+        record(logging.INFO, 'Base64 encoded storyfile size: %s',
+               base64storyfile_size)
+
+    return 0, records
+
+
 if __name__ == '__main__':
     start_time = time.time()
     args = docopt.docopt(__doc__, version=str(version))
@@ -122,174 +298,146 @@ if __name__ == '__main__':
     if args['--dev']:
         args['--devstage'] = 'development'
 
-    log.debug('%s started' % os.path.basename(__file__))
-    log.debug('docopt args=%s' % args)
+    log.debug('%s started', os.path.basename(__file__))
+    log.debug('docopt args=%s', args)
 
     if not os.path.exists(args['--informbin']):
-        log.error('Inform binary not found: %s' % args['--informbin'])
+        log.error('Inform binary not found: %s', args['--informbin'])
         sys.exit(1)
-    else:
-        command = [args['--informbin']]
-    
-    if args['--tmpdir']:
-        if not os.path.exists(args['--tmpdir']):
-            log.error('Temporary directory not found: %s' % args['--tmpdir'])
+
+    tmpdir_flag = None
+    if args['--tmpdir'] is not None:
+        if not args['--tmpdir']:
+            log.error('Temporary directory is empty')
+            sys.exit(1)
+        elif not os.path.isdir(args['--tmpdir']):
+            log.error('Temporary directory not found: %s', args['--tmpdir'])
             sys.exit(1)
         else:
-            tmpdir = '+temporary_path=%s' % args['--tmpdir']
-    
-    for infile in args['<infiles>']:
-        log.info('Processing infile: %s' % infile)
-        infiledirname, infilename = os.path.split(infile)
-        infilebasename, infileextension = os.path.splitext(infilename)
-        if infiledirname == '':
-            infiledirname = './'
+            tmpdir_flag = '+temporary_path=%s' % args['--tmpdir']
 
-        metadata, keys = getmetadata(infile)
+    if args['--outdirectory'] and not os.path.isdir(args['--outdirectory']):
+        log.error('Output directory not found: %s', args['--outdirectory'])
+        sys.exit(1)
 
-        if not args['--outdirectory']:
-            args['--outdirectory'] = infiledirname
-            log.info('Output directory --outdirectory not specified. ' +
-                     'Using same directory as source file: %s' %
-                     args['--outdirectory'])
-
-        if not os.path.isdir(args['--outdirectory']):
-            log.error('Output directory not found: %s'
-                      % args['--outdirectory'])
+    if args['--encoding']:
+        try:
+            codecs.lookup(args['--encoding'])
+        except LookupError:
+            log.error('Unknown encoding: %s', args['--encoding'])
             sys.exit(1)
+        encoding = args['--encoding']
+    elif args['--unicode']:
+        encoding = 'utf-8-sig'  # Same as utf-8, but accepts a leading BOM
+    else:
+        encoding = None  # Detect encoding of each source file
+
+    if args['--vorple']:
+        args['--gluxl'] = True
+
+    # Flags common to all infiles
+    base_cmd = [args['--informbin']]
+
+    if args['--unicode']:
+        base_cmd.append('-Cu')
+
+    if args['--devstage'] == 'release':
+        base_cmd.append('-~S')
+        # ^^ For RELEASE_VERSION use -~S: De-activate strict mode (~S)
+        # (it is on by default)
+    elif args['--devstage'] == 'development':
+        base_cmd.append('-SDX')
+        # ^^ For DEVELOPMENT_VERSION use -SDX : strict mode (S),
+        # debugger (D) and infix debugger (X)
+    if args['-v'] >= 1:  # Show compilation statistics (-s)
+        base_cmd.append('-s')
+
+    if args['--gluxl']:
+        base_cmd.append('-G')
+    else:
+        base_cmd.append('-v%s' % args['--storyfileversion'])
 
-        if args['--outdirectory'][-1] != '/':  # Ensure directory ends in /
-            args['--outdirectory'] += '/'
-
-        if not args['--storyfileprefix']:
-            args['--storyfileprefix'] = ''
-
-        if not args['--storyfilesuffix']:
-            if 'release' in metadata.keys():
-                storyfile_releasenumber = metadata['release']
-            else:
-                storyfile_releasenumber = '1'  # Default release number
-
-            if 'serial' in metadata.keys():
-                storyfile_serialnumber = metadata['serial']
-            else:
-                # Default serial number
-                storyfile_serialnumber = time.strftime('%y%m%d')
-
-            args['--storyfilesuffix'] = '_' + storyfile_releasenumber + '_' \
-                                        + storyfile_serialnumber
-
-        if args['--nostorysuffix']:
-            args['--storyfilesuffix'] = ''
-
+    if args['--vorple']:
+        base_cmd.extend(['--define', 'TARGET_VORPLE'])
 
-        if args['--vorple']:
-            args['--gluxl'] = True
+    if tmpdir_flag:
+        base_cmd.append(tmpdir_flag)
 
-        storyfilename = args['--outdirectory'] + args['--storyfileprefix'] \
-                        + infilebasename + args['--storyfilesuffix']
-        if args['--gluxl']:
-            storyfilename += '.ulx'
-        else:
-            storyfilename +=  '.z' + str(args['--storyfileversion'])
+    # Split and check all infiles and read their metadata up front, keeping
+    # only the ones to compile
+    infiles = []
+    storyfilenames = set()
+    for infile in args['<infiles>']:
+        infiledirname, infilename = os.path.split(infile)
+        infilebasename, infileextension = os.path.splitext(infilename)
+        if infiledirname == '':
+            infiledirname = './'
 
         if not os.path.isfile(infile):
-            log.warning('Infile not found: %s ... skipping it' % infile)
+            log.warning('Infile not found: %s ... skipping it', infile)
             continue
         elif infileextension != '.inf':
-            log.warning('Possibly not inform source code: %s ... skipping it'
-                        % infile)
+            log.warning('Possibly not inform source code: %s ... skipping it',
+                        infile)
             continue
 
-        if os.path.isfile(storyfilename) and not args['--force']:
-            log.warning('Storyfilename already exists: %s ... skipping (use --force or -f to overwrite)' % infile)
-            continue
+        log.info('Processing infile: %s', infile)
+        metadata, keys = getmetadata(infile, encoding=encoding)
 
-        log.info('Building command string')
-
-        if args['--unicode']:
-            command.append('-Cu')
-
-        if args['--devstage'] == 'release':
-            command.append('-~S')
-            # ^^ For RELEASE_VERSION use -~S: De-activate strict mode (~S)
-            # (it is on by default)
-        elif args['--devstage'] == 'development':
-            command.append('-SDX')
-            # ^^ For DEVELOPMENT_VERSION use -SDX : strict mode (S),
-            # debugger (D) and infix debugger (X)
-        if args['-v'] >= 1:  # Show compilation statistics (-s)
-            command.append('-s')
-
-        if 'sprog' in metadata.keys():
-            args['--language'] = metadata['sprog'].lower()
-
-        if (args['--language'].lower() == 'danish') \
-               or (args['--language'].lower() == 'dansk'):
-            command.append('+language_name=Danish')
-
-        if args['--gluxl']:
-            command.append('-G')
-
-        if not args['--gluxl']:
-            command.append('-v%s' % args['--storyfileversion'])
-
-        if args['--vorple']:
-            command.append("--define TARGET_VORPLE")
-
-        # Append source file dir to library paths
-        if args['--librarypaths']:
-          librarypaths = '+'+args['--librarypaths']+','+infiledirname
-          command.append(librarypaths)
-
-        if args['--tmpdir']:
-            command.append(tmpdir)
-            
-        command.append(infile)
-        command.append(storyfilename)
-        log.info('Compiling infile with command: %s' % ' '.join(command))
-        try:
-            returncode = subprocess.call(' '.join(command), shell=True)
-        except Exception as ex:
-            log.exception('Exception: %s' % ex)
-            sys.exit(1)
+        if not args['--outdirectory']:
+            log.info('Output directory --outdirectory not specified. '
+                     'Using same directory as source file: %s', infiledirname)
+
+        storyfilename = getstoryfilename(infiledirname, infilebasename,
+                                         metadata, args)
+        # Also skip infiles whose story file an earlier infile will write
+        if not args['--force'] and (storyfilename in storyfilenames
+                                    or os.path.isfile(storyfilename)):
+            log.warning('Storyfilename already exists: %s ... skipping (use --force or -f to overwrite)', infile)
+            continue
 
-        if returncode != 0:
-            log.error('Compilation of file: %s unsuccessful' % infile)
-            sys.exit(1)
-        else:
-            log.info('Compilation of file: %s successful' % infile)
-            log.info('Wrote storyfile: %s' % (storyfilename))
-            storyfile_md5sum = md5(storyfilename)
-            log.info('Storyfile md5sum: %s' % storyfile_md5sum)
-            storyfile_size = filesize(storyfilename)
-            log.info('Storyfile size: %s' % storyfile_size)
-            if not os.path.isfile(storyfilename):
-                log.error(' but storyfile: %s not found' % storyfilename)
+        storyfilenames.add(storyfilename)
+        infiles.append(InFile(infile, infiledirname, infilebasename,
+                              metadata, storyfilename))
+
+    # Compile in parallel only when no two infiles write the same story
+    # file (possible with --force), and only with enough infiles and cores
+    # to be worth the process pool start-up cost
+    if len(infiles) >= _PARALLEL_MIN_INFILES \
+            and (os.cpu_count() or 1) > 1 \
+            and len(storyfilenames) == len(infiles):
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            results = executor.map(compile_one, infiles,
+                                   itertools.repeat(args),
+                                   itertools.repeat(base_cmd),
+                                   itertools.repeat(True))
+            try:
+                # Replay the log records and compiler output of each infile
+                # in order
+                for returncode, records in results:
+                    for record in records:
+                        if isinstance(record, CompilerOutput):
+                            for stream, output in (
+                                    (sys.stdout, record.stdout),
+                                    (sys.stderr, record.stderr)):
+                                stream.flush()
+                                stream.buffer.write(output)
+                                stream.flush()
+                        else:
+                            level, msg, msgargs = record
+                            log.log(level, msg, *msgargs)
+                    if returncode != 0:
+                        sys.exit(1)
+            finally:
+                # Do not start queued compiles after a failure or exception
+                executor.shutdown(cancel_futures=True)
+    else:
+        for infile in infiles:
+            returncode, _ = compile_one(infile, args, base_cmd)
+            if returncode != 0:
                 sys.exit(1)
 
-        # FIXME TODO write readme.txt with metadata?
-
-        if args['--writejs']:
-            log.info('Base64 encoding of the storyfile for ' +
-                     ' parchment (javascript)')
-            # Based on code from parchment, zcode2js.py
-            contents = open(storyfilename, "rb").read()
-            encoded_contents = base64.b64encode(contents)
-            base64storyfilename = storyfilename + '.js'
-            f = open(base64storyfilename, 'w+')
-            f.write("processBase64Zcode('%s');" % encoded_contents)
-            f.close()
-            log.info('Wrote base64 encoded storyfile: %s'
-                     % (base64storyfilename))
-            base64storyfile_md5sum = md5(base64storyfilename)
-            log.info('Base64 encoded storyfile md5sum: %s'
-                     % base64storyfile_md5sum)
-            base64storyfile_size = filesize(base64storyfilename)
-            log.info('Base64 encoded storyfile size: %s'
-                     % base64storyfile_size)
-
     # FIXME TODO Symbolic link to newest?
 
-    log.debug('Processing time={0:.2f} s'.format(time.time() - start_time))
-    log.debug('%s ended' % os.path.basename(__file__))
+    log.debug('Processing time=%.2f s', time.time() - start_time)
+    log.debug('%s ended', os.path.basename(__file__))